@@ -5,12 +5,25 @@ import pandas as pd
 import os
 import sys
 import json
-import time
 import re
+import asyncio
+import hashlib
+import diskcache
 from tqdm import tqdm
 from datetime import datetime
-from openai import OpenAI
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from openai import AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception_type, wait_exponential_jitter, stop_after_attempt
+from aiolimiter import AsyncLimiter
+
+# orjson разбирает JSON быстрее стандартного модуля, если установлен
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -21,15 +34,36 @@ if not OPENAI_API_KEY:
     print("❌ Ошибка: OPENAI_API_KEY не найден в .env файле")
     sys.exit(1)
 
-# Инициализация клиента OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Инициализация асинхронного клиента OpenAI
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Кэш результатов анализа между запусками (точное совпадение model|версия промпта|url)
+CACHE_DIR = ".url_cache"
+cache = diskcache.Cache(CACHE_DIR)
+
+# Подробный вывод по каждому URL, включается флагом --verbose
+VERBOSE = False
+
+def log(message, verbose=False):
+    """
+    Выводит сообщение, не разрывая индикатор прогресса tqdm.
+    Сообщения с verbose=True выводятся только с флагом --verbose
+    """
+    if verbose and not VERBOSE:
+        return
+    tqdm.write(message)
+
+# Семантический кэш (коллекция Chroma), включается флагом --semantic-cache
+semantic_cache = None
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.97
 
-# Промпт для анализа URL
-ANALYSIS_PROMPT = """
-Ты эксперт по анализу веб-страниц в сфере банкротства физических лиц.
+# Системный промпт с критериями оценки. Передается без изменений в каждом запросе
+# (без f-строк и подстановок), чтобы провайдер мог кэшировать общий префикс запроса
+SYSTEM_RUBRIC = """Ты эксперт по анализу веб-страниц в сфере банкротства физических лиц.
 Твоя задача - детально оценить вероятность того, что посетитель данной страницы намерен ВОСПОЛЬЗОВАТЬСЯ УСЛУГОЙ БАНКРОТСТВА ФИЗЛИЦ, а не просто ищет информацию.
 
-Проанализируй URL и его контекст: {url}
+Проанализируй URL из сообщения пользователя и его контекст.
 
 На основе URL и твоих знаний о структуре и контенте сайтов о банкротстве, оцени:
 
@@ -69,7 +103,7 @@ ANALYSIS_PROMPT = """
 ВАЖНО: Верни результат строго в формате JSON:
 {
   "intentScore": число от 0 до 100,
-  "intentCategory": "соответствующая категория из списка выше",
+  "intentCategory": "transactional (предложение услуг, intentScore от 41) или informational (intentScore до 40)",
   "targetAudience": "физлица с долгами/другая аудитория",
   "transactionalElements": {
     "applicationForm": вероятность наличия от 0 до 100,
@@ -83,77 +117,150 @@ ANALYSIS_PROMPT = """
   "detailedReasoning": "детальное объяснение оценки (до 200 слов)",
   "confidence": число от 0 до 100 (насколько уверен в своей оценке)
 }
+
+Ответ должен быть строго в формате JSON без лишних символов, переносов строк или отступов. Не добавляй ничего перед или после JSON объекта.
 """
 
+# Ограничение длины ответа модели в токенах (JSON по схеме с обоснованием до 200 слов)
+DEFAULT_MAX_TOKENS = 600
+
+# JSON-схема ответа для Structured Outputs: модель гарантированно возвращает
+# валидный JSON с этими полями
+PERCENT = {"type": "integer", "minimum": 0, "maximum": 100}
+INTENT_CATEGORIES = ["transactional", "informational"]
+ANALYSIS_SCHEMA = {
+    "name": "url_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "intentScore": PERCENT,
+            "intentCategory": {"type": "string", "enum": INTENT_CATEGORIES},
+            "targetAudience": {"type": "string"},
+            "transactionalElements": {
+                "type": "object",
+                "properties": {
+                    "applicationForm": PERCENT,
+                    "calculator": PERCENT,
+                    "contactInfo": PERCENT,
+                    "callToAction": PERCENT,
+                    "chat": PERCENT
+                },
+                "required": ["applicationForm", "calculator", "contactInfo", "callToAction", "chat"],
+                "additionalProperties": False
+            },
+            "bankruptcySpecificTerms": {"type": "array", "items": {"type": "string"}},
+            "funnelStage": {"type": "string", "enum": ["awareness", "interest", "consideration", "decision"]},
+            "detailedReasoning": {"type": "string"},
+            "confidence": PERCENT
+        },
+        "required": [
+            "intentScore", "intentCategory", "targetAudience", "transactionalElements",
+            "bankruptcySpecificTerms", "funnelStage", "detailedReasoning", "confidence"
+        ],
+        "additionalProperties": False
+    }
+}
+
+# Протокол в начале URL (http://, https://)
+SCHEME_RE = re.compile(r'^[a-z][a-z0-9+.-]*://', re.I)
+
+def add_netloc_prefix(url):
+    """
+    Добавляет // к URL без протокола, иначе urlsplit не распознает домен
+    """
+    return url if url.startswith('//') or SCHEME_RE.match(url) else '//' + url
+
 def extract_domain(url):
     """
-    Извлекает домен из URL
+    Извлекает домен из URL (в нижнем регистре, без порта)
     """
     try:
-        # Удаляем протокол
-        domain = url.split('//')[1] if '//' in url else url
-        # Берем только домен (до первого слеша)
-        domain = domain.split('/')[0]
-        return domain
-    except:
-        return url
+        return urlsplit(add_netloc_prefix(url)).hostname or ''
+    except ValueError:
+        # Некорректный URL (например, незакрытая скобка IPv6)
+        return ''
 
 def get_domain_extension(domain):
     """
     Извлекает расширение домена (.ru, .com, .org и т.д.)
     """
-    try:
-        parts = domain.split('.')
-        if len(parts) > 1:
-            return parts[-1].lower()
-        return ""
-    except:
-        return ""
+    _, dot, extension = domain.rpartition('.')
+    return extension.lower() if dot else ""
+
+# Колонки с результатами анализа и их типы
+RESULT_COLUMNS = {
+    'intentScore': 'Int16',
+    'intentCategory': 'object',
+    'targetAudience': 'object',
+    'applicationForm': 'Int16',
+    'calculator': 'Int16',
+    'contactInfo': 'Int16',
+    'callToAction': 'Int16',
+    'chat': 'Int16',
+    'bankruptcySpecificTerms': 'object',
+    'funnelStage': 'object',
+    'detailedReasoning': 'object',
+    'confidence': 'object',
+    'analysis_status': 'object',
+    'error_message': 'object'
+}
+
+# Признаки русского домена: TLD .ru/.su/.рф, пуникод (xn--) или кириллица в домене
+RUSSIAN_TLDS = ('.ru', '.su', '.рф')
+CYRILLIC_RE = re.compile('[\u0400-\u04FF]')
 
 def is_russian_domain(url):
     """
     Проверяет, является ли URL русским доменом
     """
-    try:
-        if not isinstance(url, str):
-            return False
-            
-        # Нормализация URL
-        url = url.lower()
-        
-        # Прямые признаки русского домена
-        russian_tlds = ['.ru', '.su', '.rf', '.xn--p1ai', '.рф']
-        
-        # Проверка на кириллицу в URL
-        has_cyrillic = bool(re.search('[\u0400-\u04FF]', url))
-        
-        # Проверка на пункод (.xn--)
-        has_punycode = 'xn--' in url
-        
-        # Проверка на русский TLD
-        has_russian_tld = any(tld in url for tld in russian_tlds)
-        
-        return has_russian_tld or has_cyrillic or has_punycode
-    except Exception as e:
-        print(f"❌ Ошибка при проверке русского домена: {str(e)}")
+    if not isinstance(url, str):
         return False
+    domain = extract_domain(url)
+    return domain.endswith(RUSSIAN_TLDS) or 'xn--' in domain or bool(CYRILLIC_RE.search(domain))
+
+# Параметры рекламных и аналитических меток, не влияющие на содержимое страницы
+TRACKING_PARAMS = {'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'ysclid', '_openstat', 'openstat', '_ga', '_gl', 'roistat', 'etext'}
+
+def is_tracking_param(key):
+    key = key.lower()
+    return key.startswith('utm_') or key in TRACKING_PARAMS
+
+def normalize_url(url):
+    """
+    Приводит URL к нормальной форме для поиска дубликатов:
+    https, www, домен в нижнем регистре, без завершающего слеша, меток utm_* и якоря.
+    Остальные параметры сохраняются в отсортированном порядке, регистр пути не меняется
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(add_netloc_prefix(url))
+    except ValueError:
+        # Некорректный URL сравнивается как есть
+        return url
+    netloc = parts.netloc.lower()
+    if not netloc.startswith('www.'):
+        netloc = 'www.' + netloc
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(key)
+    ))
+    return urlunsplit(('https', netloc, parts.path.rstrip('/') or '/', query, ''))
 
 def process_excel_data(excel_file, output_csv, max_urls=None):
     """
     Обрабатывает Excel-файл и подготавливает данные для анализа банкротства физлиц
     """
     try:
-        # Загрузка данных из Excel
+        # Сначала читаем только заголовки, чтобы затем загрузить лишь нужные столбцы
         print(f"📊 Чтение данных из файла {excel_file}...")
-        df = pd.read_excel(excel_file)
-        original_count = len(df)
-        print(f"📈 Всего строк в файле: {original_count}")
+        columns = pd.read_excel(excel_file, nrows=0, engine='openpyxl').columns
         
         # Выводим информацию о столбцах
-        print(f"📋 Столбцы в файле: {', '.join(df.columns.tolist())}")
+        print(f"📋 Столбцы в файле: {', '.join(columns.tolist())}")
         
         # Проверка наличия колонки URL
-        url_columns = [col for col in df.columns if col.upper() == 'URL']
+        url_columns = [col for col in columns if col.upper() == 'URL']
         
         if not url_columns:
             print("❌ Ошибка: В Excel-файле отсутствует столбец с URL")
@@ -162,12 +269,12 @@ def process_excel_data(excel_file, output_csv, max_urls=None):
         # Проверка наличия столбца с трафиком
         # В файле BFLMSKvika.xlsx столбец называется "Organic Traffic  –  Ahrefs  :  URL"
         expected_traffic_column = "Organic Traffic  –  Ahrefs  :  URL"
-        if expected_traffic_column in df.columns:
+        if expected_traffic_column in columns:
             traffic_column = expected_traffic_column
             print(f"✅ Найден столбец с трафиком: {traffic_column}")
         else:
             # Ищем любой столбец с ключевыми словами по трафику
-            traffic_columns = [col for col in df.columns if 'TRAFFIC' in col.upper() or 'ORGANIC' in col.upper()]
+            traffic_columns = [col for col in columns if 'TRAFFIC' in col.upper() or 'ORGANIC' in col.upper()]
             if traffic_columns:
                 traffic_column = traffic_columns[0]
                 print(f"✅ Найден альтернативный столбец с трафиком: {traffic_column}")
@@ -178,14 +285,20 @@ def process_excel_data(excel_file, output_csv, max_urls=None):
         url_column = url_columns[0]
         print(f"✅ Найден столбец с URL: {url_column}")
         
-        # Копируем данные в стандартные столбцы
-        df['url'] = df[url_column]
+        # Загрузка из Excel только столбцов с URL и трафиком
+        usecols = [url_column] + ([traffic_column] if traffic_column else [])
+        df = pd.read_excel(excel_file, usecols=usecols, engine='openpyxl', dtype={url_column: 'string'})
+        original_count = len(df)
+        print(f"📈 Всего строк в файле: {original_count}")
+        
+        # Переименование в стандартные столбцы
+        df = df.rename(columns={url_column: 'url', traffic_column: 'TRAFFIC'})
         
         # Добавляем столбец с трафиком, если он есть
         if traffic_column:
-            df['TRAFFIC'] = df[traffic_column].fillna(0)
-            # Преобразование в числовой тип
-            df['TRAFFIC'] = df['TRAFFIC'].apply(lambda x: float(str(x).replace(',', '.')) if isinstance(x, str) else float(x))
+            # Преобразование в числовой тип (десятичная запятая заменяется на точку)
+            traffic = df['TRAFFIC'].astype(str).str.replace(',', '.', regex=False)
+            df['TRAFFIC'] = pd.to_numeric(traffic, errors='coerce').fillna(0)
             
             # Проверка количества URL с трафиком >= 40
             urls_with_traffic = len(df[df['TRAFFIC'] >= 40])
@@ -201,8 +314,14 @@ def process_excel_data(excel_file, output_csv, max_urls=None):
         print(f"✅ Отфильтровано по трафику >= 40: {len(df)} URL (удалено {traffic_before - len(df)} URL)")
         
         # Фильтрация только по русским доменам
-        # Используем улучшенную функцию проверки русских доменов
-        df['is_russian'] = df['url'].apply(is_russian_domain)
+        # Домен извлекается одним проходом, остальные проверки - операции над столбцом
+        domains = df['url'].astype('string').map(extract_domain, na_action='ignore').astype('string')
+        df['tld'] = domains.str.rsplit('.', n=1).str[-1]
+        df['is_russian'] = (
+            domains.str.endswith(RUSSIAN_TLDS)
+            | domains.str.contains('xn--', regex=False)
+            | domains.str.contains(CYRILLIC_RE.pattern, regex=True)
+        ).fillna(False)
         russian_before = len(df)
         df = df[df['is_russian'] == True]
         print(f"✅ Отфильтровано по русским доменам: {len(df)} URL (удалено {russian_before - len(df)} URL)")
@@ -215,17 +334,14 @@ def process_excel_data(excel_file, output_csv, max_urls=None):
             df = df.head(max_urls)
             print(f"✅ Ограничено до {max_urls} URL")
         
-        # Добавление колонок для анализа
-        columns_to_add = [
-            'intentScore', 'intentCategory', 'targetAudience', 
-            'applicationForm', 'calculator', 'contactInfo', 'callToAction', 'chat',
-            'bankruptcySpecificTerms', 'funnelStage', 'detailedReasoning', 'confidence',
-            'analysis_status', 'error_message'
-        ]
+        # Нормальная форма URL для объединения дубликатов (http/https, www, слеш, utm-метки)
+        df['url_norm'] = df['url'].map(normalize_url)
         
-        for col in columns_to_add:
+        # Добавление колонок для анализа с заданными типами,
+        # чтобы запись результатов через df.update не меняла тип столбцов
+        for col, dtype in RESULT_COLUMNS.items():
             if col not in df.columns:
-                df[col] = None
+                df[col] = pd.Series(index=df.index, dtype=dtype)
         
         print(f"📊 Итого: {len(df)} URL готово к анализу из {original_count} исходных")
         return df
@@ -234,222 +350,481 @@ def process_excel_data(excel_file, output_csv, max_urls=None):
         print(f"❌ Ошибка при обработке Excel-файла: {str(e)}")
         return None
 
-def analyze_url_with_openai(url, model="gpt-4.1-mini"):
+# Ключевые слова для классификации очевидных URL без обращения к модели.
+# Сравниваются с началом слов домена и пути (разделители: - . / _ и другие),
+# поэтому tourist.ru и border.ru не считаются страницами юристов
+WORD_START = r'(?<![a-zа-яё0-9])'
+WORD_END = r'(?![a-zа-яё0-9])'
+TRANSACTIONAL_RE = re.compile(WORD_START + r'(?:bankrot|consult|advokat|jurist|urist|банкрот|юрист|адвокат|zayavka|order)', re.I)
+# Информационные разделы сравниваются со словом целиком (static, status не подходят)
+INFO_RE = re.compile(WORD_START + r'(?:wiki|blogs?|news|articles?|statya|stati|statyi|novosti|novost)' + WORD_END, re.I)
+
+def classify_url_by_rules(url):
     """
-    Анализирует URL с помощью OpenAI без загрузки содержимого
+    Классифицирует URL по ключевым словам, если тип страницы очевиден.
+    Возвращает результат анализа или None, если URL нужно отправить модели
+
+    >>> classify_url_by_rules('https://bankrot-pomosh.ru/')['data']['intentCategory']
+    'transactional'
+    >>> classify_url_by_rules('https://www.urist-msk.ru/bankrotstvo/')['data']['intentCategory']
+    'transactional'
+    >>> classify_url_by_rules('https://law.ru/blog/kak-spisat-dolgi')['data']['intentCategory']
+    'informational'
+    >>> classify_url_by_rules('https://site.ru/novosti/2024/')['data']['intentCategory']
+    'informational'
+    >>> classify_url_by_rules('https://tourist.ru/') is None
+    True
+    >>> classify_url_by_rules('https://border.ru/') is None
+    True
+    >>> classify_url_by_rules('https://site.ru/static/img/logo.png') is None
+    True
+    >>> classify_url_by_rules('https://site.ru/status') is None
+    True
+    >>> classify_url_by_rules('https://site.ru/uslugi/realestate') is None
+    True
+    >>> extract_domain('site.ru//page'), normalize_url('site.ru//page')
+    ('site.ru', 'https://www.site.ru//page')
     """
-    # Дефолтное значение для случаев ошибок
-    default_result = {
-        "intentScore": 5,
-        "intentCategory": "informational",
-        "targetAudience": "individuals with debts",
-        "transactionalElements": {
-            "applicationForm": False,
-            "calculator": False,
-            "contactInfo": False,
-            "callToAction": False,
-            "chat": False
-        },
-        "bankruptcySpecificTerms": ["bankruptcy", "банкротство"],
-        "funnelStage": "awareness",
-        "detailedReasoning": "Analysis based on URL pattern only",
-        "confidence": "low"
-    }
+    path = url.split('//', 1)[-1].partition('/')[2]
+    
+    # Статьи и новости (в том числе на сайтах юридических компаний)
+    if INFO_RE.search(path):
+        return {
+            'status': 'success',
+            'data': {
+                "intentScore": 5,
+                "intentCategory": "informational",
+                "targetAudience": "individuals researching bankruptcy options",
+                "transactionalElements": {
+                    "applicationForm": 10,
+                    "calculator": 0,
+                    "contactInfo": 30,
+                    "callToAction": 10,
+                    "chat": 10
+                },
+                "bankruptcySpecificTerms": ["bankruptcy", "банкротство"],
+                "funnelStage": "awareness",
+                "detailedReasoning": "Информационная страница (статья, новости, блог) по ключевым словам в URL",
+                "confidence": "rule"
+            }
+        }
+    
+    # Короткие URL юридических компаний: главная страница или страница услуги
+    if TRANSACTIONAL_RE.search(url) and len(url) < 80 and url.count('/') <= 4:
+        return {
+            'status': 'success',
+            'data': {
+                "intentScore": 70,
+                "intentCategory": "transactional",
+                "targetAudience": "individuals with debts seeking bankruptcy services",
+                "transactionalElements": {
+                    "applicationForm": 80,
+                    "calculator": 30,
+                    "contactInfo": 90,
+                    "callToAction": 80,
+                    "chat": 50
+                },
+                "bankruptcySpecificTerms": ["bankruptcy", "банкротство", "списание долгов", "финансовый управляющий"],
+                "funnelStage": "consideration",
+                "detailedReasoning": "Страница юридической компании по банкротству по ключевым словам в URL",
+                "confidence": "rule"
+            }
+        }
+    
+    return None
+
+@lru_cache(maxsize=None)
+def get_prompt_version(max_tokens):
+    """
+    Возвращает короткий хэш промпта, схемы ответа и лимита токенов.
+    При их изменении ранее сохраненные результаты перестают находиться в кэше
+    """
+    payload = json.dumps([SYSTEM_RUBRIC, ANALYSIS_SCHEMA, max_tokens], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:12]
+
+def get_cache_key(url, model, max_tokens=DEFAULT_MAX_TOKENS):
+    """
+    Возвращает ключ кэша для модели, версии промпта и URL
+    """
+    return hashlib.sha256(f"{model}|{get_prompt_version(max_tokens)}|{url}".encode()).hexdigest()
+
+def enable_semantic_cache():
+    """
+    Подключает семантический кэш: похожие URL (например, одинаковые шаблоны страниц
+    на разных поддоменах) получают уже сохраненный результат анализа
+    """
+    global semantic_cache
+    import chromadb
+    
+    chroma_client = chromadb.PersistentClient(path=os.path.join(CACHE_DIR, "semantic"))
+    semantic_cache = chroma_client.get_or_create_collection(
+        "url_analysis", metadata={"hnsw:space": "cosine"}
+    )
+    print(f"🧠 Семантический кэш подключен ({semantic_cache.count()} URL)")
+
+async def embed_url(url):
+    """
+    Возвращает эмбеддинг URL (без протокола), сохраняя его в кэше
+    """
+    text = url.split('//', 1)[-1]
+    key = f"embedding|{EMBEDDING_MODEL}|{text}"
+    if key not in cache:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        cache[key] = response.data[0].embedding
+    return cache[key]
+
+async def get_cached_result(url, model, max_tokens=DEFAULT_MAX_TOKENS):
+    """
+    Ищет результат анализа в кэше: сначала по точному совпадению,
+    затем (если включен) в семантическом кэше по ближайшему похожему URL
+    """
+    key = get_cache_key(url, model, max_tokens)
+    if key in cache:
+        return cache[key]
+    
+    if semantic_cache is None or semantic_cache.count() == 0:
+        return None
     
     try:
-        print(f"🔎 Анализирую URL: {url}")
-        
-        # Формирование промпта для анализа URL
-        prompt = ANALYSIS_PROMPT.format(url=url)
-        
-        # Изменяем системный промпт, чтобы получить более строгий JSON
-        system_message = """Ты эксперт по анализу веб-страниц в сфере банкротства физических лиц.
-Ответ должен быть строго в формате JSON без лишних символов, переносов строк или отступов. Не добавляй ничего перед или после JSON объекта."""
-        
-        # Пытаемся получить ответ от API
+        embedding = await embed_url(url)
+        # Запросы к Chroma блокирующие, выполняем их в отдельном потоке
+        match = await asyncio.to_thread(
+            semantic_cache.query, query_embeddings=[embedding], n_results=1,
+            where={"$and": [{"model": model}, {"prompt_version": get_prompt_version(max_tokens)}]}
+        )
+        if match['ids'][0] and 1 - match['distances'][0][0] > SEMANTIC_CACHE_THRESHOLD:
+            log(f"🧠 Найден похожий URL в семантическом кэше: {match['metadatas'][0][0]['url']}", verbose=True)
+            return cache.get(match['ids'][0][0])
+    except Exception as e:
+        log(f"⚠️ Ошибка при поиске в семантическом кэше: {str(e)}")
+    return None
+
+async def get_local_result(url, model, max_tokens=DEFAULT_MAX_TOKENS):
+    """
+    Возвращает результат анализа без обращения к модели:
+    по ключевым словам в URL или из кэша
+    """
+    result = classify_url_by_rules(url)
+    if result is not None:
+        log(f"📏 URL классифицирован по ключевым словам: {url}", verbose=True)
+        return result
+    
+    result = await get_cached_result(url, model, max_tokens)
+    if result is not None:
+        log(f"💾 Результат из кэша для {url}", verbose=True)
+    return result
+
+async def store_cached_result(url, model, max_tokens, result):
+    """
+    Сохраняет успешный результат анализа в кэш
+    """
+    if result['status'] != 'success':
+        return
+    
+    key = get_cache_key(url, model, max_tokens)
+    cache[key] = {'status': 'success', 'data': result['data']}
+    
+    if semantic_cache is not None:
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1,
-                response_format={"type": "json_object"}
+            embedding = await embed_url(url)
+            await asyncio.to_thread(
+                semantic_cache.upsert, ids=[key], embeddings=[embedding], metadatas=[{"model": model, "prompt_version": get_prompt_version(max_tokens), "url": url}]
             )
+        except Exception as e:
+            log(f"⚠️ Ошибка при сохранении в семантический кэш: {str(e)}")
+
+# Системное сообщение одинаково во всех запросах и создается один раз
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_RUBRIC}
+
+@lru_cache(maxsize=None)
+def get_request_params(model, max_tokens):
+    """
+    Возвращает неизменную часть параметров запроса для модели.
+    Создается один раз на пару model/max_tokens
+    """
+    return {
+        "model": model,
+        "temperature": 0.1,
+        "top_p": 1.0,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+        # Ответ по схеме занимает несколько сотен токенов; без ограничения API резервирует
+        # под каждый запрос максимум модели в лимите токенов в минуту
+        "max_tokens": max_tokens,
+        "response_format": {"type": "json_schema", "json_schema": ANALYSIS_SCHEMA}
+    }
+
+def build_chat_request(url, model="gpt-4.1-mini", max_tokens=DEFAULT_MAX_TOKENS):
+    """
+    Формирует параметры запроса к Chat Completions API для анализа URL.
+    Используется как в обычном режиме, так и при подготовке пакетного файла
+    """
+    return {
+        **get_request_params(model, max_tokens),
+        "messages": [SYSTEM_MESSAGE, {"role": "user", "content": f"URL: {url}"}]
+    }
+
+def parse_analysis_content(content, url):
+    """
+    Разбирает JSON-ответ модели. Структура ответа гарантируется схемой
+    ANALYSIS_SCHEMA, ошибка возможна только при отказе или обрезанном ответе
+    """
+    try:
+        data = json_loads(content)
+    except (json.JSONDecodeError, TypeError) as e:
+        log(f"❌ Ошибка при парсинге JSON для {url}: {str(e)}")
+        return {
+            'status': 'error',
+            'message': f"Некорректный ответ модели: {str(e)}"
+        }
+    
+    log(f"✅ Успешный анализ для {url}", verbose=True)
+    return {
+        'status': 'success',
+        'data': data
+    }
+
+# Повторные попытки при превышении лимитов, таймаутах и ошибках сервера
+api_retry = retry(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+@api_retry
+async def create_chat_completion(request, limiter=None):
+    """
+    Выполняет запрос к Chat Completions API с повторными попытками api_retry.
+    Если передан limiter, каждая попытка ожидает свободный слот в пределах
+    лимита запросов в минуту
+    """
+    # Встроенные повторы клиента отключены только здесь, чтобы попытки не умножались
+    # и каждая из них проходила через limiter
+    chat_client = client.with_options(max_retries=0)
+    if limiter is None:
+        return await chat_client.chat.completions.create(**request)
+    async with limiter:
+        return await chat_client.chat.completions.create(**request)
+
+@api_retry
+async def retrieve_batch(batch_id):
+    """
+    Получает статус пакета. Опрос длится до 24 часов, поэтому временные
+    ошибки сети не должны прерывать ожидание
+    """
+    return await client.batches.retrieve(batch_id)
+
+async def analyze_url_with_openai(url, model="gpt-4.1-mini", limiter=None, max_tokens=DEFAULT_MAX_TOKENS):
+    """
+    Анализирует URL с помощью OpenAI без загрузки содержимого
+    """
+    # Очевидные и повторные URL обрабатываем без обращения к API
+    local_result = await get_local_result(url, model, max_tokens)
+    if local_result is not None:
+        return local_result
+    
+    log(f"🔎 Анализирую URL: {url}", verbose=True)
+    try:
+        response = await create_chat_completion(build_chat_request(url, model, max_tokens), limiter)
+    except Exception as e:
+        log(f"❌ Ошибка при вызове API для {url}: {str(e)}")
+        return {
+            'status': 'error',
+            'message': str(e)
+        }
+    
+    message = response.choices[0].message
+    if getattr(message, 'refusal', None):
+        log(f"❌ Модель отказалась анализировать {url}: {message.refusal}")
+        return {
+            'status': 'error',
+            'message': message.refusal
+        }
+    
+    result = parse_analysis_content(message.content, url)
+    await store_cached_result(url, model, max_tokens, result)
+    return result
+
+def get_batch_id_file(batch_file):
+    """
+    Возвращает путь к файлу, в котором сохраняется идентификатор созданного пакета
+    """
+    return os.path.splitext(batch_file)[0] + '.batch_id'
+
+def get_batch_error_message(error):
+    """
+    Возвращает текст ошибки запроса из выходного файла пакета
+    """
+    if isinstance(error, dict):
+        return error.get('message') or error.get('code') or str(error)
+    return str(error)
+
+async def read_batch_file(file_id, custom_ids, results):
+    """
+    Построчно читает выходной файл пакета (результаты или ошибки) и добавляет
+    в results результаты по индексам строк, еще не полученные ранее
+    """
+    async with client.files.with_streaming_response.content(file_id) as response:
+        async for line in response.iter_lines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if item.get('custom_id') not in custom_ids:
+                continue
+            idx, url = custom_ids[item['custom_id']]
+            if idx in results:
+                continue
             
-            # Получение текста ответа
-            content = response.choices[0].message.content
+            response_data = item.get('response') or {}
+            if item.get('error') or response_data.get('status_code') != 200:
+                error = item.get('error') or (response_data.get('body') or {}).get('error')
+                results[idx] = {'status': 'error', 'message': get_batch_error_message(error)}
+                continue
             
-            # Обработка возможных ошибок в формате JSON
-            try:
-                # Очистка ответа от возможного мусора
-                content = content.strip()
-                if content.startswith('```json'):
-                    content = content[7:]
-                if content.endswith('```'):
-                    content = content[:-3]
-                
-                # Проверка на наличие переносов строк и проблемы с форматированием
-                if '\n' in content:
-                    print(f"⚠️ Обнаружены переносы строк в JSON, исправляю...")
-                    # Удаляем все переносы строк и лишние пробелы
-                    content = re.sub(r'\s+', ' ', content).strip()
-                
-                # Проверка на неквотированные ключи
-                if re.search(r'[{,]\s*(\w+):', content):
-                    print(f"⚠️ Обнаружены неквотированные ключи в JSON, исправляю...")
-                    # Добавляем кавычки к ключам JSON, если они отсутствуют
-                    content = re.sub(r'([{,])\s*(\w+):', r'\1"\2":', content)
-                
-                # Обработка особого случая с ошибкой "\n  \"intentScore\""
-                if '"intentScore"' in content and '{' not in content[:15]:
-                    print(f"⚠️ Обнаружена ошибка с началом JSON, исправляю...")
-                    content = "{" + content.split("intentScore")[1]
-                    content = "{\"intentScore\"" + content
-                
-                # Дополнительная проверка на сбалансированность фигурных скобок
-                open_braces = content.count('{')
-                close_braces = content.count('}')
-                if open_braces != close_braces:
-                    print(f"⚠️ Несбалансированные скобки в JSON: {open_braces} открывающих, {close_braces} закрывающих")
-                    if open_braces > close_braces:
-                        content += "}" * (open_braces - close_braces)
-                    else:
-                        content = "{" * (close_braces - open_braces) + content
-                
-                # Дополнительная проверка на запятые в конце полей
-                content = re.sub(r',\s*}', '}', content)
-                
-                # Попытка парсинга JSON
-                data = json.loads(content)
-                print(f"✅ Успешный анализ для {url}")
-                return {
-                    'status': 'success',
-                    'data': data
-                }
-            except json.JSONDecodeError as json_err:
-                print(f"❌ Ошибка при парсинге JSON: {str(json_err)}")
-                print(f"📑 Часть ответа: {content[:100]}...")
-                
-                # В случае ошибки парсинга возвращаем значения по умолчанию
-                # Создаем базовую оценку на основе URL
-                site_type = "informational"
-                intent_score = 5
-                
-                # Если URL похож на сайт юридической компании по банкротству
-                if any(term in url.lower() for term in ['bankrot', 'consult', 'lawyer', 'jurist', 'urist', 'банкрот', 'юрист']):
-                    site_type = "transactional"
-                    intent_score = 8
-                    default_result["intentCategory"] = site_type
-                    default_result["intentScore"] = intent_score
-                    default_result["transactionalElements"]["contactInfo"] = True
-                    default_result["transactionalElements"]["applicationForm"] = True
-                    default_result["funnelStage"] = "consideration"
-                
-                return {
-                    'status': 'success',
-                    'data': default_result
-                }
-                
-        except Exception as api_err:
-            print(f"❌ Ошибка при вызове API: {str(api_err)}")
-            return {
-                'status': 'success',
-                'data': default_result
-            }
+            content = response_data['body']['choices'][0]['message']['content']
+            results[idx] = parse_analysis_content(content, url)
+
+async def run_batch(df, model, max_tokens, batch_file, poll_interval, batch_id=None):
+    """
+    Анализирует URL через OpenAI Batch API: формирует JSONL-файл с запросами,
+    загружает его, ожидает завершения пакета и возвращает результаты по индексам строк.
+    Если передан batch_id, создание пакета пропускается и ожидается уже созданный пакет
+    """
+    # custom_id - индекс строки в DataFrame
+    custom_ids = {str(idx): (idx, url) for idx, url in zip(df.index.to_numpy(), df['url'].to_numpy())}
+    batch_id_file = get_batch_id_file(batch_file)
     
-    except Exception as e:
-        error_str = str(e)
-        print(f"❌ Общая ошибка: {error_str}")
-        
-        # Обработка специфической ошибки '\n  "intentScore"'
-        if '"intentScore"' in error_str:
-            try:
-                print("⚙️ Попытка восстановления JSON из ошибки...")
-                # Анализ URL и заголовка для умного определения типа
-                transactional_keywords = ['bankrot', 'consult', 'advokat', 'jurist', 'urist', 'банкрот', 'юрист', 'адвокат', 'центр', 'услуг']
-                is_transactional = any(keyword in url.lower() for keyword in transactional_keywords)
-                
-                # Добавляем интеллектуальную обработку для разных типов URL
-                if is_transactional:
-                    # Транзакционный URL (юридическая компания)
-                    print(f"💰 URL определен как транзакционный: {url}")
-                    custom_result = {
-                        "intentScore": 8,
-                        "intentCategory": "transactional",
-                        "targetAudience": "individuals with debts seeking bankruptcy services",
-                        "transactionalElements": {
-                            "applicationForm": True,
-                            "calculator": True,
-                            "contactInfo": True,
-                            "callToAction": True,
-                            "chat": True
-                        },
-                        "bankruptcySpecificTerms": ["bankruptcy", "банкротство", "списание долгов", "финансовый управляющий"],
-                        "funnelStage": "consideration",
-                        "detailedReasoning": "URL принадлежит юридической компании, предоставляющей услуги по банкротству физлиц",
-                        "confidence": "medium"
-                    }
-                elif 'law' in url.lower() or 'konsult' in url.lower() or 'garant' in url.lower() or 'fedresurs' in url.lower():
-                    # Информационный URL с высокой ценностью
-                    print(f"📚 URL определен как информационный с высокой ценностью: {url}")
-                    custom_result = {
-                        "intentScore": 6,
-                        "intentCategory": "informational",
-                        "targetAudience": "individuals researching bankruptcy options",
-                        "transactionalElements": {
-                            "applicationForm": False,
-                            "calculator": False,
-                            "contactInfo": True,
-                            "callToAction": False,
-                            "chat": False
-                        },
-                        "bankruptcySpecificTerms": ["bankruptcy", "банкротство", "закон", "процедура"],
-                        "funnelStage": "awareness",
-                        "detailedReasoning": "URL содержит информацию о законодательстве по банкротству физлиц",
-                        "confidence": "medium"
-                    }
-                else:
-                    # Стандартный информационный URL
-                    print(f"📃 URL определен как обычный информационный: {url}")
-                    custom_result = default_result
-                
-                return {
-                    'status': 'success',
-                    'data': custom_result
+    if batch_id:
+        batch = await retrieve_batch(batch_id)
+        print(f"📦 Продолжаем ожидание пакета {batch.id} (статус: {batch.status})")
+    else:
+        # Формирование входного файла пакета
+        with open(batch_file, 'w', encoding='utf-8') as f:
+            for custom_id, (idx, url) in custom_ids.items():
+                line = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": build_chat_request(url, model, max_tokens)
                 }
-            except Exception as recovery_err:
-                print(f"❌ Ошибка при попытке восстановления JSON: {str(recovery_err)}")
+                f.write(json.dumps(line, ensure_ascii=False) + '\n')
+        print(f"📝 Сформирован файл пакета {batch_file} ({len(custom_ids)} запросов)")
         
-        # Возвращаем значения по умолчанию в случае ошибки
+        # Загрузка файла и создание пакета
+        with open(batch_file, 'rb') as f:
+            input_file = await client.files.create(file=f, purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        # Идентификатор сохраняется, чтобы после сбоя можно было забрать результаты через --batch-id
+        with open(batch_id_file, 'w', encoding='utf-8') as f:
+            f.write(batch.id)
+        print(f"📦 Пакет {batch.id} создан (идентификатор сохранен в {batch_id_file}), ожидаем завершения...")
+        print(f"ℹ️ Если запуск прервется, продолжите его с параметром --batch-id {batch.id}")
+    
+    # Ожидание завершения пакета
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        await asyncio.sleep(poll_interval)
+        batch = await retrieve_batch(batch.id)
+        counts = batch.request_counts
+        if counts:
+            print(f"⏳ Статус пакета: {batch.status} (выполнено: {counts.completed}/{counts.total}, ошибок: {counts.failed})")
+        else:
+            print(f"⏳ Статус пакета: {batch.status}")
+    
+    results = {}
+    if batch.status != 'completed':
+        print(f"❌ Пакет {batch.id} завершился со статусом {batch.status}")
+    # Выполненные запросы попадают в output_file_id и при статусах expired/cancelled,
+    # а ошибки запросов - в error_file_id
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            await read_batch_file(file_id, custom_ids, results)
+    
+    # Запросы без ответа в выходном файле помечаем как ошибочные
+    for idx, url in custom_ids.values():
+        if idx not in results:
+            results[idx] = {'status': 'error', 'message': f"Нет результата в пакете {batch.id} (статус: {batch.status})"}
+    
+    # Пакет завершен и его результаты получены, продолжать его больше не нужно
+    if os.path.exists(batch_id_file):
+        os.remove(batch_id_file)
+    
+    return results
+
+def result_to_row(idx, result):
+    """
+    Преобразует результат анализа URL в строку для записи в DataFrame
+    """
+    if result['status'] == 'success':
+        data = result['data']
+        transactional = data.get('transactionalElements', {})
         return {
-            'status': 'success',  # Меняем на success чтобы не блокировать обработку
-            'data': default_result
+            'idx': idx,
+            'intentScore': data.get('intentScore'),
+            'intentCategory': data.get('intentCategory'),
+            'targetAudience': data.get('targetAudience'),
+            # Транзакционные элементы
+            'applicationForm': transactional.get('applicationForm'),
+            'calculator': transactional.get('calculator'),
+            'contactInfo': transactional.get('contactInfo'),
+            'callToAction': transactional.get('callToAction'),
+            'chat': transactional.get('chat'),
+            # Другие поля
+            'bankruptcySpecificTerms': ', '.join(data.get('bankruptcySpecificTerms', [])),
+            'funnelStage': data.get('funnelStage'),
+            'detailedReasoning': data.get('detailedReasoning'),
+            'confidence': data.get('confidence'),
+            'analysis_status': 'success'
         }
+    
+    return {
+        'idx': idx,
+        'analysis_status': 'error',
+        'error_message': result.get('message', 'Неизвестная ошибка')
+    }
 
-def main():
+def apply_results(df, rows):
     """
-    Основная функция для запуска анализа URL по банкротству физлиц
+    Записывает накопленные строки результатов в DataFrame одной операцией,
+    очищает список и возвращает индексы обновленных строк
     """
-    import argparse
-    
-    parser = argparse.ArgumentParser(description="Анализ URL на предмет намерения воспользоваться услугой банкротства физлиц")
-    parser.add_argument("--excel", type=str, default="BFLMSKvika.xlsx", 
-                        help="Excel файл с данными о URL и трафике")
-    parser.add_argument("--output", type=str, default="bankruptcy_intent_results.csv", 
-                        help="Имя выходного CSV-файла")
-    parser.add_argument("--model", type=str, default="gpt-4.1-mini", 
-                        help="Модель OpenAI для анализа")
-    parser.add_argument("--max", type=int, default=None, 
-                        help="Максимальное количество URL для анализа")
-    parser.add_argument("--batch-size", type=int, default=10, 
-                        help="Размер пакета URL для промежуточного сохранения результатов")
-    parser.add_argument("--delay", type=float, default=0.5, 
-                        help="Задержка между запросами в секундах")
-    
-    args = parser.parse_args()
+    if not rows:
+        return []
     
+    updates = pd.DataFrame(rows).set_index('idx')
+    for col in updates.columns:
+        if RESULT_COLUMNS.get(col) == 'Int16':
+            updates[col] = pd.to_numeric(updates[col], errors='coerce').round().astype('Int16')
+    df.update(updates)
+    rows.clear()
+    return updates.index.tolist()
+
+def append_results(df, indices, output):
+    """
+    Дописывает в CSV только строки с новыми результатами
+    """
+    df.loc[indices].to_csv(output, index=False, header=False, mode='a', encoding='utf-8-sig')
+
+async def analyze_one(semaphore, limiter, idx, url, model, max_tokens):
+    """
+    Анализирует один URL, ограничивая число одновременных запросов семафором
+    """
+    async with semaphore:
+        try:
+            result = await analyze_url_with_openai(url, model, limiter, max_tokens)
+        except Exception as e:
+            result = {'status': 'error', 'message': str(e)}
+        return idx, result
+
+async def main_async(args):
+    """
+    Асинхронный анализ URL с ограниченным числом одновременных запросов к OpenAI
+    """
     # Обработка Excel-файла
     df = process_excel_data(args.excel, args.output, args.max)
     
@@ -457,71 +832,158 @@ def main():
         print("❌ Нет данных для анализа после фильтрации")
         return
     
-    print(f"🚀 Начинаем анализ {len(df)} URL с использованием модели {args.model}")
-    
     # Анализ URL
     total_urls = len(df)
     success_count = 0
     error_count = 0
     
-    # Использование tqdm для отображения прогресса
-    for i, (idx, row) in enumerate(tqdm(df.iterrows(), total=total_urls, desc="Анализ URL")):
-        url = row['url']
+    if args.semantic_cache:
+        enable_semantic_cache()
+    
+    semaphore = asyncio.Semaphore(args.concurrency)
+    
+    # Дубликаты после нормализации анализируются один раз: ключ - индекс первой строки,
+    # значение - индексы всех строк с тем же url_norm
+    duplicates = {group[0]: group for group in df.groupby('url_norm', sort=False).groups.values()}
+    unique = df.loc[list(duplicates)]
+    print(f"🔁 Уникальных URL после нормализации: {len(unique)} из {total_urls}")
+    
+    # Обход через массивы NumPy без создания Series для каждой строки
+    indices = unique.index.to_numpy()
+    urls = unique['url'].to_numpy()
+    
+    if args.mode == 'batch':
+        # В пакет попадают только URL, которые нельзя определить по правилам или из кэша
+        async def lookup(idx, url):
+            async with semaphore:
+                return idx, await get_local_result(url, args.model, args.max_tokens)
+        
+        local = await asyncio.gather(*(lookup(idx, url) for idx, url in zip(indices, urls)))
+        results = {idx: result for idx, result in local if result is not None}
+        pending = unique.drop(index=list(results))
+        print(f"💾 Определено без обращения к модели (правила и кэш): {len(results)} URL")
+        
+        if len(pending) > 0:
+            print(f"🚀 Начинаем пакетный анализ {len(pending)} URL с использованием модели {args.model}")
+            batch_results = await run_batch(
+                pending, args.model, args.max_tokens, args.batch_file, args.poll_interval, args.batch_id
+            )
+            for idx, result in batch_results.items():
+                await store_cached_result(df.at[idx, 'url'], args.model, args.max_tokens, result)
+            results.update(batch_results)
         
-        # Анализ URL
-        result = analyze_url_with_openai(url, args.model)
+        rows = []
+        for idx, result in results.items():
+            rows.extend(result_to_row(dup, result) for dup in duplicates[idx])
+            if result['status'] == 'success':
+                success_count += len(duplicates[idx])
+            else:
+                error_count += len(duplicates[idx])
+        indices = apply_results(df, rows)
+        if args.format == 'csv':
+            df.head(0).to_csv(args.output, index=False, encoding='utf-8-sig', mode='w')
+            append_results(df, indices, args.output)
+        finalize_results(df, args.output, args.format, total_urls, success_count, error_count)
+        return
+    
+    print(f"🚀 Начинаем анализ {len(df)} URL с использованием модели {args.model} (одновременных запросов: {args.concurrency}, лимит в минуту: {args.rpm or 'нет'})")
+    
+    # Все запросы запускаются сразу, семафор ограничивает количество одновременных,
+    # а limiter - количество запросов в минуту
+    limiter = AsyncLimiter(args.rpm, 60) if args.rpm else None
+    tasks = [
+        asyncio.create_task(analyze_one(semaphore, limiter, idx, url, args.model, args.max_tokens))
+        for idx, url in zip(indices, urls)
+    ]
+    
+    # Прогресс обновляется по завершении каждой задачи, перерисовка - не чаще
+    # 2 раз в секунду и не более ~1000 раз за весь анализ
+    pbar = tqdm(
+        total=len(tasks), desc="Анализ URL",
+        mininterval=0.5, miniters=max(1, len(tasks) // 1000), smoothing=0
+    )
+    for task in tasks:
+        task.add_done_callback(lambda _: pbar.update(1))
+    
+    # Результаты накапливаются и при каждом сохранении дописываются в CSV,
+    # заголовок записывается один раз. Parquet сохраняется целиком в конце анализа
+    rows = []
+    if args.format == 'csv':
+        df.head(0).to_csv(args.output, index=False, encoding='utf-8-sig', mode='w')
+    
+    # Обработка результатов по мере завершения запросов
+    for i, future in enumerate(asyncio.as_completed(tasks)):
+        idx, result = await future
+        rows.extend(result_to_row(dup, result) for dup in duplicates[idx])
         
-        # Обновление данных в DataFrame
         if result['status'] == 'success':
-            data = result['data']
-            df.at[idx, 'intentScore'] = data.get('intentScore')
-            df.at[idx, 'intentCategory'] = data.get('intentCategory')
-            df.at[idx, 'targetAudience'] = data.get('targetAudience')
-            
-            # Транзакционные элементы
-            transactional = data.get('transactionalElements', {})
-            df.at[idx, 'applicationForm'] = transactional.get('applicationForm')
-            df.at[idx, 'calculator'] = transactional.get('calculator')
-            df.at[idx, 'contactInfo'] = transactional.get('contactInfo')
-            df.at[idx, 'callToAction'] = transactional.get('callToAction')
-            df.at[idx, 'chat'] = transactional.get('chat')
-            
-            # Другие поля
-            df.at[idx, 'bankruptcySpecificTerms'] = ', '.join(data.get('bankruptcySpecificTerms', []))
-            df.at[idx, 'funnelStage'] = data.get('funnelStage')
-            df.at[idx, 'detailedReasoning'] = data.get('detailedReasoning')
-            df.at[idx, 'confidence'] = data.get('confidence')
-            df.at[idx, 'analysis_status'] = 'success'
-            
-            success_count += 1
+            success_count += len(duplicates[idx])
         else:
-            df.at[idx, 'analysis_status'] = 'error'
-            df.at[idx, 'error_message'] = result.get('message', 'Неизвестная ошибка')
-            
-            error_count += 1
+            error_count += len(duplicates[idx])
         
         # Промежуточное сохранение результатов
-        if (i + 1) % args.batch_size == 0 or i == total_urls - 1:
-            df.to_csv(args.output, index=False, encoding='utf-8-sig')
-            print(f"\n💾 Промежуточное сохранение после {i + 1} URL (успешно: {success_count}, ошибок: {error_count})")
-        
-        # Задержка между запросами
-        if i < total_urls - 1 and args.delay > 0:
-            time.sleep(args.delay)
-    
-    # Сохраняем финальные результаты
-    df.to_csv(args.output, index=False, encoding='utf-8-sig')
+        if (i + 1) % args.batch_size == 0 or i == len(tasks) - 1:
+            indices = apply_results(df, rows)
+            if args.format == 'csv':
+                # Запись на диск в отдельном потоке, чтобы не задерживать обработку ответов API
+                await asyncio.to_thread(append_results, df, indices, args.output)
+                log(f"💾 Промежуточное сохранение после {i + 1} URL (успешно: {success_count}, ошибок: {error_count})")
+    pbar.close()
     
-    # Создаем отфильтрованный файл с высоким intent score
-    high_intent_urls = df[df['intentScore'] >= 7].sort_values(by='intentScore', ascending=False)
-    high_intent_file = args.output.replace('.csv', '_high_intent.csv')
-    if len(high_intent_urls) > 0:
-        high_intent_urls.to_csv(high_intent_file, index=False, encoding='utf-8-sig')
+    finalize_results(df, args.output, args.format, total_urls, success_count, error_count)
+
+def get_partition_category(categories):
+    """
+    Возвращает категорию для разбиения набора данных: значения вне INTENT_CATEGORIES
+    (ошибки, результаты старых версий промпта) заменяются на other,
+    чтобы имена каталогов оставались короткими
+
+    >>> get_partition_category(pd.Series(['transactional', '61-80%: Коммерческая страница с явным предложением услуг банкротства', None])).tolist()
+    ['transactional', 'other', 'other']
+    """
+    return categories.where(categories.isin(INTENT_CATEGORIES), 'other')
+
+def finalize_results(df, output, output_format, total_urls, success_count, error_count):
+    """
+    Сохраняет URL с высоким намерением и выводит итоговую статистику.
+    Для CSV результаты уже записаны по ходу анализа и читаются одним проходом,
+    для Parquet все результаты сохраняются здесь
+    """
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        
+        # Столбцы со смешанными значениями (например, confidence: число или "rule") сохраняются строками
+        results = df.astype({col: 'string' for col in df.columns if df[col].dtype == object})
+        output = os.path.splitext(output)[0] + '.parquet'
+        results.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+        
+        # URL с высоким intent score сохраняются набором данных с разбиением по категории
+        high_intent_urls = results[results['intentScore'] >= 7].sort_values(by='intentScore', ascending=False)
+        high_intent_file = os.path.splitext(output)[0] + '_high_intent'
+        if len(high_intent_urls) > 0:
+            partitioned = high_intent_urls.assign(intentCategory=get_partition_category(high_intent_urls['intentCategory']))
+            ds.write_dataset(
+                pa.Table.from_pandas(partitioned, preserve_index=False),
+                high_intent_file,
+                format='parquet',
+                partitioning=['intentCategory'],
+                partitioning_flavor='hive',
+                existing_data_behavior='delete_matching'
+            )
+    else:
+        results = pd.read_csv(output, usecols=['url', 'intentScore', 'intentCategory'], encoding='utf-8-sig')
+        
+        # Создаем отфильтрованный файл с высоким intent score
+        high_intent_urls = results[results['intentScore'] >= 7].sort_values(by='intentScore', ascending=False)
+        high_intent_file = output.replace('.csv', '_high_intent.csv')
+        if len(high_intent_urls) > 0:
+            high_intent_urls.to_csv(high_intent_file, index=False, encoding='utf-8-sig')
     
     # Итоговая статистика
     print(f"\n✅ Анализ завершен! Обработано {total_urls} URL")
     print(f"📊 Успешно: {success_count}, Ошибок: {error_count}")
-    print(f"📋 Результаты сохранены в {args.output}")
+    print(f"📋 Результаты сохранены в {output}")
     
     # Вывод информации о URL с высоким намерением
     high_intent_count = len(high_intent_urls)
@@ -531,8 +993,53 @@ def main():
         
         # Выводим топ-5 URL с высоким намерением
         print("\n🔝 Топ-5 URL с высоким намерением:")
-        for i, (idx, row) in enumerate(high_intent_urls.head(5).iterrows()):
-            print(f"{i+1}. {row['url']} - Score: {row['intentScore']} (Категория: {row['intentCategory']})")    
+        for i, row in enumerate(high_intent_urls.head(5).itertuples(index=False)):
+            print(f"{i+1}. {row.url} - Score: {row.intentScore} (Категория: {row.intentCategory})")    
+
+def main():
+    """
+    Основная функция для запуска анализа URL по банкротству физлиц
+    """
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Анализ URL на предмет намерения воспользоваться услугой банкротства физлиц")
+    parser.add_argument("--excel", type=str, default="BFLMSKvika.xlsx", 
+                        help="Excel файл с данными о URL и трафике")
+    parser.add_argument("--output", type=str, default="bankruptcy_intent_results.csv", 
+                        help="Имя выходного CSV-файла")
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv", 
+                        help="Формат результатов: csv (с промежуточными сохранениями) или parquet (требуется pyarrow)")
+    parser.add_argument("--model", type=str, default="gpt-4.1-mini", 
+                        help="Модель OpenAI для анализа")
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS, 
+                        help="Максимальная длина ответа модели в токенах")
+    parser.add_argument("--max", type=int, default=None, 
+                        help="Максимальное количество URL для анализа")
+    parser.add_argument("--batch-size", type=int, default=10, 
+                        help="Размер пакета URL для промежуточного сохранения результатов")
+    parser.add_argument("--concurrency", type=int, default=20, 
+                        help="Максимальное количество одновременных запросов к OpenAI")
+    parser.add_argument("--rpm", type=int, default=500, 
+                        help="Лимит запросов к OpenAI в минуту (0 - без ограничения)")
+    parser.add_argument("--mode", type=str, choices=["realtime", "batch"], default="realtime", 
+                        help="Режим анализа: realtime - запросы к API в реальном времени, batch - через OpenAI Batch API")
+    parser.add_argument("--batch-file", type=str, default="batch_input.jsonl", 
+                        help="JSONL-файл с запросами для режима batch")
+    parser.add_argument("--batch-id", type=str, default=None, 
+                        help="Идентификатор уже созданного пакета: пропустить создание и дождаться его результатов (режим batch)")
+    parser.add_argument("--poll-interval", type=float, default=60, 
+                        help="Интервал проверки статуса пакета в секундах (режим batch)")
+    parser.add_argument("--semantic-cache", action="store_true", 
+                        help="Использовать семантический кэш похожих URL (требуется chromadb)")
+    parser.add_argument("--verbose", action="store_true", 
+                        help="Выводить сообщения по каждому URL (по умолчанию выводятся только ошибки и индикатор прогресса)")
+    
+    args = parser.parse_args()
+    
+    global VERBOSE
+    VERBOSE = args.verbose
+    
+    asyncio.run(main_async(args))
 
 if __name__ == "__main__":
     main()